@@ -4,23 +4,39 @@ import os
 os.environ['TF_ENABLE_ONEDNN_OPTS'] = '0'
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'  # 0=all, 1=filter INFO, 2=filter WARNING, 3=filter ERROR
 
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory, stream_with_context
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+import orjson
 from youtube_transcript_api import YouTubeTranscriptApi
 from youtube_transcript_api._errors import TranscriptsDisabled, NoTranscriptFound
 from google import genai
 from google.genai import types
+from google.genai import errors as genai_errors
+import httpx
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
 import chromadb
 from chromadb.config import Settings
 import os
 from dotenv import load_dotenv
 import re
-from urllib.parse import urlparse, parse_qs
-from sentence_transformers import SentenceTransformer
-import PyPDF2
+import hashlib
+import itertools
+import platform
+import torch
+import onnxruntime
+from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+import pypdfium2 as pdfium
+import pdf_worker
 from werkzeug.utils import secure_filename
 import uuid
 from datetime import datetime
+from urllib.parse import urlparse
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import threading
 import easyocr
 import numpy as np
 import cv2
@@ -28,21 +44,205 @@ import cv2
 # Load environment variables
 load_dotenv()
 
+
+class ORJSONProvider(JSONProvider):
+    """JSON provider backed by orjson, used by jsonify() and request.json"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 CORS(app)
 
+# Routes run concurrently under gunicorn's gthread workers. Shared state stays safe because:
+# - PDFium is not thread-safe even across documents, so every in-process pdfium call holds
+#   _pdfium_lock; large PDFs are parsed in the forkserver pool's separate processes
+# - the embedding model and its fast tokenizer are shared, so every forward pass and every
+#   tokenizer call holds _embedding_lock (the tokenizer raises "Already borrowed" otherwise)
+# - EasyOCR's reader is not documented as thread-safe, so readtext() holds _ocr_lock
+# - the SQLite registry serializes its shared connection with _registry_lock, and routes that
+#   read-modify-write documents or workspaces hold _registry_write_lock for the whole update
+# - CTranslate2 (faster-whisper), the Chroma client, the genai client and lru_cache are thread-safe
+_pdfium_lock = threading.Lock()
+_embedding_lock = threading.Lock()
+_ocr_lock = threading.Lock()
+
 # Configure Gemini API (only for chat, not embeddings)
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 if not GEMINI_API_KEY:
     raise ValueError("GEMINI_API_KEY not found in environment variables. Please create a .env file with your API key.")
 
-client = genai.Client(api_key=GEMINI_API_KEY)
+GEMINI_MODEL = 'gemini-2.5-flash-lite'
+GEMINI_TIMEOUT_MS = 60 * 1000
+
+# One process-wide client so every chat request reuses its pooled keep-alive connections
+client = genai.Client(api_key=GEMINI_API_KEY, http_options=types.HttpOptions(timeout=GEMINI_TIMEOUT_MS))
+
+
+def _is_transient_gemini_error(e):
+    """Rate limits, server errors and network timeouts are worth retrying"""
+    if isinstance(e, genai_errors.APIError):
+        return e.code == 429 or e.code >= 500
+    return isinstance(e, httpx.TransportError)
+
+
+_gemini_retry = retry(
+    retry=retry_if_exception(_is_transient_gemini_error),
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, max=8),
+    reraise=True
+)
+
+
+@_gemini_retry
+def generate_answer(prompt):
+    """Generate a Gemini response, retrying transient failures"""
+    return client.models.generate_content(model=GEMINI_MODEL, contents=prompt)
+
+
+@_gemini_retry
+def open_answer_stream(prompt):
+    """Start a streamed Gemini response, retrying transient failures until the first chunk arrives"""
+    stream = client.models.generate_content_stream(model=GEMINI_MODEL, contents=prompt)
+    first_chunk = next(stream, None)
+    return first_chunk, stream
 
 # Initialize Sentence Transformer for local embeddings
+EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
+# Quantized ONNX export is cached next to ./chroma_db so it is only built once
+EMBEDDING_MODEL_DIR = './embedding_model'
+# Roughly the physical core count; sizes the embedding session and the PDF worker pool
+PHYSICAL_CORES = max(1, (os.cpu_count() or 2) // 2)
+
+
+def _onnx_quantization_config():
+    """Pick the int8 quantization preset that matches this CPU"""
+    if platform.machine().lower() in ('arm64', 'aarch64'):
+        return 'arm64'
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            cpu_flags = f.read()
+    except OSError:
+        cpu_flags = ''
+    if 'avx512_vnni' in cpu_flags:
+        return 'avx512_vnni'
+    if 'avx512f' in cpu_flags:
+        return 'avx512'
+    return 'avx2'
+
+
+def load_embedding_model():
+    """Load the embedding model as an int8-quantized ONNX model, exporting it on first run"""
+    if torch.cuda.is_available():
+        # GPU inference runs the PyTorch model under fp16 autocast instead
+        return SentenceTransformer(EMBEDDING_MODEL_NAME, device='cuda')
+
+    quantization_config = _onnx_quantization_config()
+    onnx_file = f"onnx/model_qint8_{quantization_config}.onnx"
+    try:
+        if not os.path.exists(os.path.join(EMBEDDING_MODEL_DIR, onnx_file)):
+            print(f"Exporting int8 ONNX embedding model ({quantization_config})...")
+            onnx_model = SentenceTransformer(EMBEDDING_MODEL_NAME, backend='onnx')
+            onnx_model.save(EMBEDDING_MODEL_DIR)
+            export_dynamic_quantized_onnx_model(onnx_model, quantization_config, EMBEDDING_MODEL_DIR)
+        # Limit only the embedding session's threads; Whisper and EasyOCR keep their own defaults
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = PHYSICAL_CORES
+        session_options.inter_op_num_threads = 1
+        return SentenceTransformer(
+            EMBEDDING_MODEL_DIR,
+            backend='onnx',
+            model_kwargs={'file_name': onnx_file, 'session_options': session_options}
+        )
+    except Exception as e:
+        print(f"Warning: int8 ONNX embeddings unavailable ({str(e)}), falling back to PyTorch FP32")
+        return SentenceTransformer(EMBEDDING_MODEL_NAME)
+
+
 print("Loading Sentence Transformer model...")
-embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
+embedding_model = load_embedding_model()
 print("Sentence Transformer loaded!")
 
+EMBEDDING_BATCH_SIZE = 64
+
+
+def _encode(texts):
+    """Run the embedding model over texts, returning normalized float32 embeddings"""
+    encode_kwargs = {
+        'batch_size': EMBEDDING_BATCH_SIZE,
+        'show_progress_bar': False,
+        'convert_to_numpy': True,
+        'normalize_embeddings': True,
+    }
+    with _embedding_lock:
+        if embedding_model.device.type == 'cuda':
+            with torch.autocast('cuda', dtype=torch.float16):
+                return embedding_model.encode(texts, **encode_kwargs).astype(np.float32)
+        return embedding_model.encode(texts, precision='float32', **encode_kwargs)
+
+
+def embed_texts(texts):
+    """Encode texts into a float32 ndarray, embedding repeated texts only once"""
+    unique_texts = []
+    unique_index = {}
+    inverse = np.empty(len(texts), dtype=np.intp)
+    for i, text in enumerate(texts):
+        key = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+        if key not in unique_index:
+            unique_index[key] = len(unique_texts)
+            unique_texts.append(text)
+        inverse[i] = unique_index[key]
+    
+    embeddings = _encode(unique_texts)
+    if len(unique_texts) == len(texts):
+        return embeddings
+    print(f"Embedded {len(unique_texts)} unique chunks out of {len(texts)}")
+    return embeddings[inverse]
+
+
+# Captured once so single-question embeds can skip encode()'s batching machinery
+query_tokenizer = embedding_model.tokenizer
+query_device = embedding_model.device
+
+
+def _encode_query(question):
+    """Tokenize one question and run the model forward directly, returning a (1, dim) float32 array"""
+    with _embedding_lock:
+        features = query_tokenizer(
+            [question],
+            padding=True,
+            truncation=True,
+            max_length=embedding_model.max_seq_length,
+            return_tensors='pt'
+        ).to(query_device)
+        with torch.inference_mode():
+            if query_device.type == 'cuda':
+                with torch.autocast('cuda', dtype=torch.float16):
+                    embedding = embedding_model(dict(features))['sentence_embedding']
+            else:
+                embedding = embedding_model(dict(features))['sentence_embedding']
+    embedding = torch.nn.functional.normalize(embedding.float(), p=2, dim=1)
+    return embedding.cpu().numpy()
+
+
+# Warm up so the first real request doesn't pay for lazy kernel/session initialization
+embed_texts(['warmup'])
+_encode_query('warmup')
+
+
+@lru_cache(maxsize=1024)
+def _embed_query(question):
+    """Embed a normalized question as a (1, dim) array; cached so repeated questions skip the model"""
+    query_embedding = _encode_query(question)
+    # The cached array is shared between requests, so guard it against mutation
+    query_embedding.setflags(write=False)
+    return query_embedding
+
 # Initialize faster-whisper for local audio transcription (free, no API needed)
 print("Loading Whisper model (base)... this may take a moment on first run...")
 from faster_whisper import WhisperModel
@@ -57,6 +257,46 @@ print("EasyOCR reader loaded!")
 
 # Initialize ChromaDB with persistent storage
 chroma_client = chromadb.PersistentClient(path="./chroma_db")
+# Embeddings are unit-normalized, so index them for cosine distance
+HNSW_SPACE = {"hnsw:space": "cosine"}
+
+
+@lru_cache(maxsize=256)
+def _get_collection(name):
+    """Cached collection handle lookup; clear the cache whenever a collection is deleted"""
+    return chroma_client.get_collection(name)
+
+
+class _NoRetrievalResults(Exception):
+    """Raised inside _retrieve_cached so empty results are never cached"""
+
+
+@lru_cache(maxsize=1024)
+def _retrieve_cached(document_id, question):
+    doc_info = _registry_get(document_id)
+    collection = _get_collection(doc_info['collection_name'])
+    results = collection.query(
+        query_embeddings=_embed_query(question),
+        n_results=5
+    )
+    if not results['documents'] or not results['documents'][0]:
+        raise _NoRetrievalResults()
+    return tuple(results['documents'][0]), tuple(results['metadatas'][0])
+
+
+def _retrieve(document_id, question):
+    """Top chunks for a normalized question against one document, as (documents, metadatas)"""
+    try:
+        return _retrieve_cached(document_id, question)
+    except _NoRetrievalResults:
+        return (), ()
+
+
+def _clear_collection_caches():
+    """Drop cached collection handles and retrievals after a collection is deleted or rebuilt"""
+    _get_collection.cache_clear()
+    _retrieve_cached.cache_clear()
+
 
 # Configure file uploads
 UPLOAD_FOLDER = './uploads'
@@ -71,136 +311,245 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
 
 import json
+import sqlite3
 
+REGISTRY_DB = 'registry.sqlite'
+# Legacy JSON registry, imported into SQLite on first start
 REGISTRY_FILE = 'registry.json'
 
-# Unified document registry (videos + PDFs)
-documents_registry = {}
+# Unified document registry (videos + PDFs) and knowledge workspaces, one JSON payload per row
+registry_db = sqlite3.connect(REGISTRY_DB, check_same_thread=False)
+registry_db.execute('PRAGMA journal_mode=WAL')
+registry_db.execute('CREATE TABLE IF NOT EXISTS docs(id TEXT PRIMARY KEY, payload TEXT)')
+registry_db.execute('CREATE TABLE IF NOT EXISTS workspaces(id TEXT PRIMARY KEY, payload TEXT)')
+registry_db.execute('CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value TEXT)')
+registry_db.commit()
+_registry_lock = threading.Lock()
+# Held by routes across a whole read-modify-write of docs/workspaces rows, so a concurrent
+# rename, delete or workspace merge can't be lost by another request writing back a stale copy
+_registry_write_lock = threading.RLock()
+
+
+def _kv_get(table, item_id):
+    with _registry_lock:
+        row = registry_db.execute(f'SELECT payload FROM {table} WHERE id = ?', (item_id,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def _kv_put(table, item):
+    payload = json.dumps(item)
+    with _registry_lock, registry_db:
+        registry_db.execute(
+            f'INSERT INTO {table}(id, payload) VALUES (?, ?) '
+            'ON CONFLICT(id) DO UPDATE SET payload = excluded.payload',
+            (item['id'], payload)
+        )
+
+
+def _kv_del(table, item_id):
+    with _registry_lock, registry_db:
+        registry_db.execute(f'DELETE FROM {table} WHERE id = ?', (item_id,))
+
+
+def _kv_list(table):
+    with _registry_lock:
+        rows = registry_db.execute(f'SELECT payload FROM {table} ORDER BY rowid').fetchall()
+    return [json.loads(row[0]) for row in rows]
+
+
+def _meta_get(key):
+    with _registry_lock:
+        row = registry_db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+    return row[0] if row else None
+
+
+def _meta_put(key, value):
+    with _registry_lock, registry_db:
+        registry_db.execute(
+            'INSERT INTO meta(key, value) VALUES (?, ?) '
+            'ON CONFLICT(key) DO UPDATE SET value = excluded.value',
+            (key, value)
+        )
+
+
+def _registry_get(doc_id):
+    return _kv_get('docs', doc_id)
+
+
+def _registry_put(doc):
+    _kv_put('docs', doc)
+
+
+def _registry_del(doc_id):
+    _kv_del('docs', doc_id)
+
+
+def _registry_list():
+    return _kv_list('docs')
+
+
+def _workspace_get(workspace_id):
+    return _kv_get('workspaces', workspace_id)
+
+
+def _workspace_put(workspace):
+    _kv_put('workspaces', workspace)
+
+
+def _workspace_del(workspace_id):
+    _kv_del('workspaces', workspace_id)
+
+
+def _workspace_list():
+    return _kv_list('workspaces')
+
+
+def import_legacy_registry():
+    """Copy documents and workspaces from registry.json into the SQLite registry, returning success"""
+    try:
+        with open(REGISTRY_FILE, 'r') as f:
+            data = json.load(f)
+        # Try all possible key names for documents
+        documents = data.get('documents') or data.get('sources') or {}
+        
+        # Try all possible key names for workspaces
+        # Priority: 'workspaces' (new), then 'personal_spaces' (reverted style), then 'spaces'
+        workspaces = data.get('workspaces') or data.get('personal_spaces') or data.get('spaces') or {}
+        
+        for doc_id, doc in documents.items():
+            doc.setdefault('id', doc_id)
+            _registry_put(doc)
+        for ws_id, ws in workspaces.items():
+            ws.setdefault('id', ws_id)
+            _workspace_put(ws)
+        print(f"Imported {len(documents)} documents and {len(workspaces)} workspaces from {REGISTRY_FILE}")
+        return True
+    except Exception as e:
+        print(f"Error importing registry: {e}")
+        return False
 
-# Knowledge workspaces registry
-workspaces = {}
 
 def load_registry():
-    global documents_registry, workspaces
-    if os.path.exists(REGISTRY_FILE):
-        try:
-            with open(REGISTRY_FILE, 'r') as f:
-                data = json.load(f)
-                # Try all possible key names for documents
-                documents_registry = data.get('documents') or data.get('sources') or {}
+    # registry.json is imported at most once, so emptying the registry later doesn't resurrect it
+    if not _meta_get('legacy_registry_imported'):
+        imported = True
+        if os.path.exists(REGISTRY_FILE) and not _registry_list() and not _workspace_list():
+            imported = import_legacy_registry()
+        if imported:
+            _meta_put('legacy_registry_imported', datetime.now().isoformat())
+    
+    # Patch existing orphaned sources that are in workspaces
+    try:
+        for ws in _workspace_list():
+            ws_id = ws['id']
+            patched = False
+            # Auto-upgrade older workspaces with independent sources array
+            if 'sources' not in ws:
+                ws['sources'] = []
+                patched = True
+            
+            existing_source_ids = [s['id'] for s in ws['sources']]
+            
+            for doc_id in ws.get('document_ids', []):
+                doc = _registry_get(doc_id)
+                if not doc:
+                    continue
                 
-                # Try all possible key names for workspaces
-                # Priority: 'workspaces' (new), then 'personal_spaces' (reverted style), then 'spaces'
-                workspaces = data.get('workspaces') or data.get('personal_spaces') or data.get('spaces') or {}
+                # Protect source lists so global delete doesn't break them
+                if doc_id not in existing_source_ids:
+                    ws['sources'].append({
+                        'id': doc['id'],
+                        'name': doc.get('name', 'Unknown'),
+                        'type': doc.get('type', 'unknown')
+                    })
+                    patched = True
                 
-                # Patch existing orphaned sources that are in workspaces
-                try:
-                    patched = False
-                    for ws_id, ws in workspaces.items():
-                        # Auto-upgrade older workspaces with independent sources array
-                        if 'sources' not in ws:
-                            ws['sources'] = []
-                            patched = True
-                        
-                        existing_source_ids = [s['id'] for s in ws['sources']]
-                        
-                        for doc_id in ws.get('document_ids', []):
-                            if doc_id in documents_registry:
-                                doc = documents_registry[doc_id]
-                                
-                                # Protect source lists so global delete doesn't break them
-                                if doc_id not in existing_source_ids:
-                                    ws['sources'].append({
-                                        'id': doc['id'],
-                                        'name': doc.get('name', 'Unknown'),
-                                        'type': doc.get('type', 'unknown')
-                                    })
-                                    patched = True
-                                
-                                # Isolate workspace-exclusive documents from global view
-                                if not doc.get('parent_workspace_id'):
-                                    doc['parent_workspace_id'] = ws_id
-                                    patched = True
-                                    print(f"🩹 Patched orphan source {doc_id} to workspace {ws_id}")
-                    if patched:
-                        save_registry()
-                except Exception as e:
-                    print(f"Warning: Registry patch failed: {str(e)}")
-
-                print(f"Loaded {len(documents_registry)} documents and {len(workspaces)} workspaces.")
-        except Exception as e:
-            print(f"Error loading registry: {e}")
-
-def save_registry():
-    try:
-        with open(REGISTRY_FILE, 'w') as f:
-            json.dump({
-                'documents': documents_registry,
-                'workspaces': workspaces
-            }, f, indent=4)
+                # Isolate workspace-exclusive documents from global view
+                if not doc.get('parent_workspace_id'):
+                    doc['parent_workspace_id'] = ws_id
+                    _registry_put(doc)
+                    print(f"🩹 Patched orphan source {doc_id} to workspace {ws_id}")
+            if patched:
+                _workspace_put(ws)
     except Exception as e:
-        print(f"Error saving registry: {e}")
+        print(f"Warning: Registry patch failed: {str(e)}")
+    
+    print(f"Loaded {len(_registry_list())} documents and {len(_workspace_list())} workspaces.")
 
 load_registry()
 
 
+# Matches watch?v=, youtu.be/, /embed/, /shorts/ and /live/ URL shapes; the lookahead rejects
+# ids longer than 11 characters instead of truncating them
+_YT_RE = re.compile(r'(?:[?&]v=|youtu\.be/|/embed/|/shorts/|/live/)([A-Za-z0-9_-]{11})(?![A-Za-z0-9_-])')
+_YT_HOSTS = ('youtube.com', 'youtu.be', 'youtube-nocookie.com')
+
+
 def extract_video_id(url):
     """Extract YouTube video ID from URL"""
-    parsed_url = urlparse(url)
-    
-    if parsed_url.hostname in ('www.youtube.com', 'youtube.com'):
-        if parsed_url.path == '/watch':
-            return parse_qs(parsed_url.query).get('v', [None])[0]
-    elif parsed_url.hostname == 'youtu.be':
-        return parsed_url.path[1:]
-    
-    return None
+    # Accept scheme-less input like "youtu.be/..." but only YouTube hosts and their subdomains
+    host = urlparse(url if '//' in url else f'//{url}').hostname or ''
+    if not any(host == h or host.endswith('.' + h) for h in _YT_HOSTS):
+        return None
+    match = _YT_RE.search(url)
+    return match.group(1) if match else None
+
+
+TRANSCRIPT_CACHE_DIR = './cache/transcripts'
+
+
+def _transcript_cache_path(video_id):
+    return os.path.join(TRANSCRIPT_CACHE_DIR, f"{video_id}.json")
+
+
+def load_cached_transcript(video_id):
+    """Return the cached transcript snippets for a video, or None if not cached"""
+    cache_path = _transcript_cache_path(video_id)
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Warning: Ignoring unreadable transcript cache {cache_path}: {str(e)}")
+        return None
+
+
+def save_cached_transcript(video_id, transcript):
+    """Atomically write transcript snippets to the on-disk cache"""
+    cache_path = _transcript_cache_path(video_id)
+    tmp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.makedirs(TRANSCRIPT_CACHE_DIR, exist_ok=True)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(transcript, f, ensure_ascii=False)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Warning: Could not cache transcript for {video_id}: {str(e)}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 
 def chunk_transcript(transcript, chunk_size=500, overlap=100):
     """Split transcript into overlapping chunks"""
-    chunks = []
-    text_parts = []
-    
+    # Flatten once into words, each tagged with the start time of the snippet it came from
+    words = []
+    starts = []
     for entry in transcript:
-        text_parts.append({
-            'text': entry['text'],
-            'start': entry['start']
-        })
-    
-    # Combine into chunks
-    current_chunk = []
-    current_length = 0
-    current_start_time = None
+        entry_words = entry['text'].split()
+        words.extend(entry_words)
+        starts.extend([entry['start']] * len(entry_words))
     
-    for i, part in enumerate(text_parts):
-        # Anchor the start time strictly to the first snippet that enters the chunk
-        if current_start_time is None:
-            current_start_time = part['start']
-            
-        words = part['text'].split()
-        current_chunk.extend(words)
-        current_length += len(words)
-        
-        if current_length >= chunk_size:
-            chunk_text = ' '.join(current_chunk)
-            chunks.append({
-                'text': chunk_text,
-                'start_time': current_start_time
-            })
-            
-            # Keep overlap for next chunk
-            current_chunk = current_chunk[-overlap:] if len(current_chunk) > overlap else []
-            current_length = len(current_chunk)
-            # Reset start time anchor so it grabs the next snippet's timestamp
-            current_start_time = None
-    
-    # Add remaining text
-    if current_chunk:
+    chunks = []
+    step = chunk_size - overlap
+    for i in range(0, len(words), step):
         chunks.append({
-            'text': ' '.join(current_chunk),
-            'start_time': current_start_time if current_start_time is not None else text_parts[-1]['start']
+            'text': ' '.join(words[i:i + chunk_size]),
+            'start_time': starts[i]
         })
+        # The window has reached the end of the transcript
+        if i + chunk_size >= len(words):
+            break
     
     return chunks
 
@@ -215,26 +564,98 @@ def allowed_audio_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_AUDIO_EXTENSIONS
 
 
-def extract_text_from_pdf(pdf_path):
-    """Extract text from PDF file"""
+# Below this many pages the process pool startup costs more than it saves
+PARALLEL_PDF_MIN_PAGES = 8
+
+
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+
+def _pdf_pool_available():
+    """Whether large PDFs can go to the worker pool instead of being extracted serially"""
+    # Pool workers re-import the __main__ script; when that is app.py itself (`python app.py`)
+    # each worker would reload every model and reopen Chroma, so stay serial there
+    if __name__ == '__main__':
+        return False
+    # The pool needs forkserver, which Windows doesn't provide
+    return PHYSICAL_CORES >= 2 and 'forkserver' in multiprocessing.get_all_start_methods()
+
+
+def _get_pdf_pool():
+    """Start the shared PDF extraction pool on first use"""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            # forkserver workers start from a fresh interpreter instead of forking this
+            # multi-threaded process with every model loaded. Only used when __main__ is
+            # not app.py (e.g. under gunicorn), so re-importing __main__ stays cheap.
+            mp_context = multiprocessing.get_context('forkserver')
+            mp_context.set_forkserver_preload(['__main__', 'pdf_worker'])
+            _pdf_pool = ProcessPoolExecutor(max_workers=PHYSICAL_CORES, mp_context=mp_context)
+    return _pdf_pool
+
+
+def _reset_pdf_pool(broken_pool):
+    """Discard a pool whose worker died so the next call starts a fresh one"""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is broken_pool:
+            _pdf_pool = None
+    broken_pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _extract_pages_in_pool(pdf_data, total_pages):
+    """Extract all pages across the worker pool, as (page_index, text, error) tuples"""
+    # One contiguous page range per worker, so the bytes are shipped once per worker
+    pages_per_task = -(-total_pages // PHYSICAL_CORES)
+    pool = _get_pdf_pool()
+    try:
+        futures = [
+            pool.submit(pdf_worker.extract_page_range, pdf_data, start, min(start + pages_per_task, total_pages))
+            for start in range(0, total_pages, pages_per_task)
+        ]
+        return [result for future in futures for result in future.result()]
+    except BrokenProcessPool:
+        _reset_pdf_pool(pool)
+        raise
+
+
+def extract_text_from_pdf(pdf_data):
+    """Extract text from in-memory PDF bytes, spreading large documents across CPU cores"""
     text_parts = []
     try:
-        with open(pdf_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            total_pages = len(pdf_reader.pages)
-            
-            for page_num, page in enumerate(pdf_reader.pages, 1):
-                try:
-                    text = page.extract_text()
-                    if text and text.strip():
-                        text_parts.append(text)
-                        print(f"   ✅ Page {page_num}/{total_pages}")
-                except Exception as e:
-                    print(f"   ❌ Page {page_num}/{total_pages}: {str(e)}")
-            
-            full_text = '\n\n'.join(text_parts)
-            print(f"✅ Extracted {len(full_text)} characters from {total_pages} pages")
-            return full_text
+        with _pdfium_lock:
+            pdf = pdfium.PdfDocument(pdf_data)
+            try:
+                total_pages = len(pdf)
+            finally:
+                pdf.close()
+        
+        if total_pages < PARALLEL_PDF_MIN_PAGES or not _pdf_pool_available():
+            with _pdfium_lock:
+                results = pdf_worker.extract_page_range(pdf_data, 0, total_pages)
+        else:
+            try:
+                results = _extract_pages_in_pool(pdf_data, total_pages)
+            except BrokenProcessPool:
+                # A worker died (OOM kill, or another upload crashed PDFium); retry once on a
+                # fresh pool. If this PDF breaks it again, the error is reported for this upload
+                # only and the next request still gets a new pool.
+                print("⚠️ PDF worker pool broke, retrying on a fresh pool")
+                results = _extract_pages_in_pool(pdf_data, total_pages)
+        
+        for page_index, text, error in results:
+            page_num = page_index + 1
+            if error:
+                print(f"   ❌ Page {page_num}/{total_pages}: {error}")
+            elif text and text.strip():
+                text_parts.append(text)
+                print(f"   ✅ Page {page_num}/{total_pages}")
+        
+        full_text = '\n\n'.join(text_parts)
+        print(f"✅ Extracted {len(full_text)} characters from {total_pages} pages")
+        return full_text
     except Exception as e:
         raise Exception(f"Error reading PDF: {str(e)}")
 
@@ -244,17 +665,32 @@ def chunk_text(text, chunk_size=1000, overlap=200):
     words = text.split()
     chunks = []
     
+    # Slice chunks out of one joined string using cumulative word offsets
+    joined = ' '.join(words)
+    lengths = np.fromiter((len(w) + 1 for w in words), dtype=np.int64, count=len(words))
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    
     for i in range(0, len(words), chunk_size - overlap):
-        chunk_words = words[i:i + chunk_size]
-        chunk_text = ' '.join(chunk_words)
+        end = min(i + chunk_size, len(words))
         chunks.append({
-            'text': chunk_text,
+            'text': joined[offsets[i]:offsets[end] - 1],
             'chunk_index': len(chunks)
         })
     
     return chunks
 
 
+def _bulk_add(collection, ids, embeddings, documents, metadatas, batch=500):
+    """Add rows to a collection in bounded batches instead of one giant insert"""
+    for i in range(0, len(ids), batch):
+        collection.add(
+            ids=ids[i:i + batch],
+            embeddings=embeddings[i:i + batch],
+            documents=documents[i:i + batch],
+            metadatas=metadatas[i:i + batch]
+        )
+
+
 
 @app.route('/api/process-video', methods=['POST'])
 def process_video():
@@ -264,7 +700,7 @@ def process_video():
         video_url = data.get('url')
         workspace_id = data.get('workspace_id')
         
-        if workspace_id and workspace_id not in workspaces:
+        if workspace_id and not _workspace_get(workspace_id):
             return jsonify({'error': 'Target workspace not found'}), 404
             
         if not video_url:
@@ -275,81 +711,91 @@ def process_video():
         if not video_id:
             return jsonify({'error': 'Invalid YouTube URL'}), 400
         
+        # Reuse a previously fetched transcript unless the client asks for a fresh one
+        force = bool(data.get('force'))
+        transcript = None if force else load_cached_transcript(video_id)
+        
         # Get transcript
-        try:
-            from youtube_transcript_api.proxies import GenericProxyConfig
-            import requests
-            import urllib3
+        if transcript is None:
+            try:
+                from youtube_transcript_api.proxies import GenericProxyConfig
+                import requests
+                import urllib3
             
-            # Proxies like ScraperAPI intercept requests and use custom SSL certificates
-            # We disable SSL warnings so the console doesn't get flooded.
-            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+                # Proxies like ScraperAPI intercept requests and use custom SSL certificates
+                # We disable SSL warnings so the console doesn't get flooded.
+                urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
             
-            proxy_url = os.getenv('PROXY_URL')
+                proxy_url = os.getenv('PROXY_URL')
             
-            # Configure custom session to disable SSL verification when using a proxy
-            client = requests.Session()
-            if proxy_url:
-                client.verify = False 
+                # Configure custom session to disable SSL verification when using a proxy
+                client = requests.Session()
+                if proxy_url:
+                    client.verify = False 
                 
-            # Pass the proxy to the API initialization if it exists
-            proxy_config = GenericProxyConfig(http_url=proxy_url, https_url=proxy_url) if proxy_url else None
-            api = YouTubeTranscriptApi(proxy_config=proxy_config, http_client=client)
+                # Pass the proxy to the API initialization if it exists
+                proxy_config = GenericProxyConfig(http_url=proxy_url, https_url=proxy_url) if proxy_url else None
+                api = YouTubeTranscriptApi(proxy_config=proxy_config, http_client=client)
             
-            # Try to get transcript in multiple languages
-            # Priority: Hindi, English, then any available
-            try:
-                # Try Hindi first
-                transcript_data = api.fetch(video_id, languages=['hi'])
-            except:
+                # Try to get transcript in multiple languages
+                # Priority: Hindi, English, then any available
                 try:
-                    # Try English
-                    transcript_data = api.fetch(video_id, languages=['en'])
+                    # Try Hindi first
+                    transcript_data = api.fetch(video_id, languages=['hi'])
                 except:
-                    # Try any available language
-                    transcript_list = api.list(video_id)
-                    # Get the first available transcript
-                    available_transcripts = list(transcript_list)
-                    if available_transcripts:
-                        first_transcript = available_transcripts[0]
-                        transcript_data = api.fetch(video_id, languages=[first_transcript.language_code])
-                    else:
-                        raise NoTranscriptFound("No transcripts available")
+                    try:
+                        # Try English
+                        transcript_data = api.fetch(video_id, languages=['en'])
+                    except:
+                        # Try any available language
+                        transcript_list = api.list(video_id)
+                        # Get the first available transcript
+                        available_transcripts = list(transcript_list)
+                        if available_transcripts:
+                            first_transcript = available_transcripts[0]
+                            transcript_data = api.fetch(video_id, languages=[first_transcript.language_code])
+                        else:
+                            raise NoTranscriptFound("No transcripts available")
             
-            # Convert snippets to the expected format.
-            # Depending on youtube-transcript-api version, it returns a dict list directly, or objects.
-            try:
-                if hasattr(transcript_data[0], 'text'):
-                    transcript = [{'text': s.text, 'start': float(s.start)} for s in transcript_data]
-                else:
-                    transcript = [{'text': s.get('text', ''), 'start': float(s.get('start', 0.0))} for s in transcript_data]
-            except Exception as inner_e:
-                # Fallback to older snippet format if necessary
-                if hasattr(transcript_data, 'snippets'):
-                    transcript = [{'text': getattr(s, 'text', ''), 'start': float(getattr(s, 'start', 0.0))} for s in transcript_data.snippets]
-                else:
-                    raise inner_e
+                # Convert snippets to the expected format.
+                # Depending on youtube-transcript-api version, it returns a dict list directly, or objects.
+                try:
+                    if hasattr(transcript_data[0], 'text'):
+                        transcript = [{'text': s.text, 'start': float(s.start)} for s in transcript_data]
+                    else:
+                        transcript = [{'text': s.get('text', ''), 'start': float(s.get('start', 0.0))} for s in transcript_data]
+                except Exception as inner_e:
+                    # Fallback to older snippet format if necessary
+                    if hasattr(transcript_data, 'snippets'):
+                        transcript = [{'text': getattr(s, 'text', ''), 'start': float(getattr(s, 'start', 0.0))} for s in transcript_data.snippets]
+                    else:
+                        raise inner_e
                 
-        except TranscriptsDisabled:
-            return jsonify({'error': 'Transcripts are disabled for this video'}), 400
-        except NoTranscriptFound:
-            return jsonify({'error': 'No transcript found for this video. Please try a video with captions/subtitles.'}), 400
-        except Exception as e:
-            return jsonify({'error': f'Error fetching transcript: {str(e)}'}), 400
+            except TranscriptsDisabled:
+                return jsonify({'error': 'Transcripts are disabled for this video'}), 400
+            except NoTranscriptFound:
+                return jsonify({'error': 'No transcript found for this video. Please try a video with captions/subtitles.'}), 400
+            except Exception as e:
+                return jsonify({'error': f'Error fetching transcript: {str(e)}'}), 400
+            
+            save_cached_transcript(video_id, transcript)
         
         # Chunk the transcript
         chunks = chunk_transcript(transcript)
-        
+        if not chunks:
+            return jsonify({'error': 'Transcript is empty'}), 400
+
         # Create or get collection for this video
         collection_name = f"video_{video_id}"
         try:
             chroma_client.delete_collection(collection_name)
         except:
             pass
+        _clear_collection_caches()
         
         collection = chroma_client.create_collection(
             name=collection_name,
-            metadata={"video_id": video_id}
+            metadata={"video_id": video_id, **HNSW_SPACE}
         )
         
         # Generate embeddings and store in ChromaDB
@@ -359,19 +805,14 @@ def process_video():
         
         # Use local Sentence Transformer for embeddings (MUCH faster!)
         print(f"Generating embeddings for {len(texts)} chunks...")
-        embeddings = embedding_model.encode(texts, show_progress_bar=True).tolist()
+        embeddings = embed_texts(texts)
         print("Embeddings generated successfully!")
         
-        collection.add(
-            embeddings=embeddings,
-            documents=texts,
-            metadatas=metadatas,
-            ids=ids
-        )
+        _bulk_add(collection, ids, embeddings, texts, metadatas)
         
         # Store in unified document registry
         doc_id = f"youtube_{video_id}"
-        documents_registry[doc_id] = {
+        _registry_put({
             'id': doc_id,
             'type': 'youtube',
             'name': f"YouTube Video ({video_id[:8]}...)",
@@ -380,8 +821,9 @@ def process_video():
             'chunks_count': len(chunks),
             'parent_workspace_id': workspace_id,
             'created_at': datetime.now().isoformat()
-        }
-        save_registry()
+        })
+        # Drop anything a chat cached while the collection was being rebuilt
+        _clear_collection_caches()
         
         return jsonify({
             'success': True,
@@ -409,92 +851,71 @@ def process_pdf():
             return jsonify({'error': 'No file selected'}), 400
         
         workspace_id = request.form.get('workspace_id')
-        if workspace_id and workspace_id not in workspaces:
+        if workspace_id and not _workspace_get(workspace_id):
             return jsonify({'error': 'Target workspace not found'}), 404
             
         if not allowed_file(file.filename):
             return jsonify({'error': 'Invalid file type. Only PDF files are allowed.'}), 400
         
-        # Save file temporarily
+        # Read the upload into memory; PDFium parses the bytes directly
         filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        pdf_data = file.read()
         
-        workspace_id = request.form.get('workspace_id')
+        # Extract text from PDF
+        print(f"📄 Processing PDF: {filename}")
+        text = extract_text_from_pdf(pdf_data)
         
-        # Validate workspace_id if provided
-        if workspace_id and workspace_id not in workspaces:
-            if os.path.exists(filepath):
-                os.remove(filepath)
-            return jsonify({'error': 'Invalid workspace_id: workspace not found'}), 400
+        if not text or len(text.strip()) < 100:
+            return jsonify({'error': 'PDF appears to be empty or contains too little text'}), 400
+        
+        # Chunk the text
+        chunks = chunk_text(text)
+        print(f"📊 Created {len(chunks)} chunks")
+        
+        # Create collection for this PDF
+        doc_id = f"pdf_{str(uuid.uuid4())[:8]}"
+        collection_name = doc_id
         
         try:
-            # Extract text from PDF
-            print(f"📄 Processing PDF: {filename}")
-            text = extract_text_from_pdf(filepath)
-            
-            if not text or len(text.strip()) < 100:
-                return jsonify({'error': 'PDF appears to be empty or contains too little text'}), 400
-            
-            # Chunk the text
-            chunks = chunk_text(text)
-            print(f"📊 Created {len(chunks)} chunks")
-            
-            # Create collection for this PDF
-            doc_id = f"pdf_{str(uuid.uuid4())[:8]}"
-            collection_name = doc_id
-            
-            try:
-                chroma_client.delete_collection(collection_name)
-            except:
-                pass
-            
-            collection = chroma_client.create_collection(
-                name=collection_name,
-                metadata={"document_id": doc_id, "filename": filename}
-            )
-            
-            # Generate embeddings
-            texts = [chunk['text'] for chunk in chunks]
-            metadatas = [{'chunk_index': chunk['chunk_index'], 'filename': filename} for chunk in chunks]
-            ids = [f"chunk_{i}" for i in range(len(chunks))]
-            
-            print(f"Generating embeddings for {len(texts)} chunks...")
-            embeddings = embedding_model.encode(texts, show_progress_bar=True).tolist()
-            print("Embeddings generated successfully!")
-            
-            collection.add(
-                embeddings=embeddings,
-                documents=texts,
-                metadatas=metadatas,
-                ids=ids
-            )
-            
-            # Store in document registry
-            documents_registry[doc_id] = {
-                'id': doc_id,
-                'type': 'pdf',
-                'name': filename,
-                'collection_name': collection_name,
-                'chunks_count': len(chunks),
-                'parent_workspace_id': workspace_id,
-                'created_at': datetime.now().isoformat()
-            }
-            save_registry()
-            
-            return jsonify({
-                'success': True,
-                'document_id': doc_id,
-                'filename': filename,
-                'chunks_created': len(chunks),
-                'message': 'PDF processed successfully'
-            })
+            chroma_client.delete_collection(collection_name)
+        except:
+            pass
         
-        finally:
-            # Clean up uploaded file
-            if os.path.exists(filepath):
-                os.remove(filepath)
-    
+        collection = chroma_client.create_collection(
+            name=collection_name,
+            metadata={"document_id": doc_id, "filename": filename, **HNSW_SPACE}
+        )
+        
+        # Generate embeddings
+        texts = [chunk['text'] for chunk in chunks]
+        metadatas = [{'chunk_index': chunk['chunk_index'], 'filename': filename} for chunk in chunks]
+        ids = [f"chunk_{i}" for i in range(len(chunks))]
+        
+        print(f"Generating embeddings for {len(texts)} chunks...")
+        embeddings = embed_texts(texts)
+        print("Embeddings generated successfully!")
+        
+        _bulk_add(collection, ids, embeddings, texts, metadatas)
+        
+        # Store in document registry
+        _registry_put({
+            'id': doc_id,
+            'type': 'pdf',
+            'name': filename,
+            'collection_name': collection_name,
+            'chunks_count': len(chunks),
+            'parent_workspace_id': workspace_id,
+            'created_at': datetime.now().isoformat()
+        })
+        
+        return jsonify({
+            'success': True,
+            'document_id': doc_id,
+            'filename': filename,
+            'chunks_created': len(chunks),
+            'message': 'PDF processed successfully'
+        })
+
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -511,7 +932,7 @@ def process_image():
             return jsonify({'error': 'No file selected'}), 400
             
         workspace_id = request.form.get('workspace_id')
-        if workspace_id and workspace_id not in workspaces:
+        if workspace_id and not _workspace_get(workspace_id):
             return jsonify({'error': 'Target workspace not found'}), 404
         
         if not allowed_file(file.filename):
@@ -524,12 +945,13 @@ def process_image():
         workspace_id = request.form.get('workspace_id')
         
         # Validate workspace_id if provided
-        if workspace_id and workspace_id not in workspaces:
+        if workspace_id and not _workspace_get(workspace_id):
             return jsonify({'error': 'Invalid workspace_id: workspace not found'}), 400
         
         try:
             print(f"🖼️ OCR Processing: {filename}")
-            results = ocr_reader.readtext(filepath)
+            with _ocr_lock:
+                results = ocr_reader.readtext(filepath)
             extracted_text = " ".join([res[1] for res in results])
             
             if not extracted_text or len(extracted_text.strip()) < 10:
@@ -546,17 +968,17 @@ def process_image():
             
             collection = chroma_client.create_collection(
                 name=collection_name,
-                metadata={"document_id": doc_id, "filename": filename, "source": "ocr"}
+                metadata={"document_id": doc_id, "filename": filename, "source": "ocr", **HNSW_SPACE}
             )
             
             texts = [chunk['text'] for chunk in chunks]
             metadatas = [{'chunk_index': chunk['chunk_index'], 'filename': filename} for chunk in chunks]
             ids = [f"chunk_{i}" for i in range(len(chunks))]
             
-            embeddings = embedding_model.encode(texts, show_progress_bar=True).tolist()
-            collection.add(embeddings=embeddings, documents=texts, metadatas=metadatas, ids=ids)
+            embeddings = embed_texts(texts)
+            _bulk_add(collection, ids, embeddings, texts, metadatas)
             
-            documents_registry[doc_id] = {
+            _registry_put({
                 'id': doc_id,
                 'type': 'image',
                 'name': f"OCR: {filename}",
@@ -564,8 +986,7 @@ def process_image():
                 'chunks_count': len(chunks),
                 'parent_workspace_id': workspace_id,
                 'created_at': datetime.now().isoformat()
-            }
-            save_registry()
+            })
             
             return jsonify({
                 'success': True,
@@ -592,7 +1013,7 @@ def process_text():
         text = data.get('text', '')
         parent_workspace_id = data.get('workspace_id')
         
-        if parent_workspace_id and parent_workspace_id not in workspaces:
+        if parent_workspace_id and not _workspace_get(parent_workspace_id):
             return jsonify({'error': 'Target workspace not found'}), 404
             
         if not text:
@@ -605,18 +1026,14 @@ def process_text():
         doc_id = f"note_{str(uuid.uuid4())[:8]}"
         collection_name = doc_id
         
-        collection = chroma_client.create_collection(name=collection_name)
+        collection = chroma_client.create_collection(name=collection_name, metadata=HNSW_SPACE)
         
         # Add chunks to collection
         texts = [c['text'] for c in chunks]
-        embeddings = embedding_model.encode(texts, show_progress_bar=False).tolist()
+        embeddings = embed_texts(texts)
         metadatas = [{'source': title, 'index': i, 'type': 'note'} for i in range(len(chunks))]
-        collection.add(
-            embeddings=embeddings,
-            documents=texts,
-            metadatas=metadatas,
-            ids=[f"{doc_id}_{i}" for i in range(len(chunks))]
-        )
+        ids = [f"{doc_id}_{i}" for i in range(len(chunks))]
+        _bulk_add(collection, ids, embeddings, texts, metadatas)
         
         # Add to registry
         doc_info = {
@@ -628,8 +1045,7 @@ def process_text():
             'parent_workspace_id': parent_workspace_id,
             'created_at': datetime.now().isoformat()
         }
-        documents_registry[doc_id] = doc_info
-        save_registry()
+        _registry_put(doc_info)
         
         return jsonify({
             'success': True,
@@ -664,7 +1080,7 @@ def process_audio():
         base_name = os.path.splitext(filename)[0]
         
         workspace_id = request.form.get('workspace_id')
-        if workspace_id and workspace_id not in workspaces:
+        if workspace_id and not _workspace_get(workspace_id):
             return jsonify({'error': 'Target workspace not found'}), 404
 
         try:
@@ -701,7 +1117,7 @@ def process_audio():
 
             collection = chroma_client.create_collection(
                 name=collection_name,
-                metadata={"document_id": doc_id, "filename": filename}
+                metadata={"document_id": doc_id, "filename": filename, **HNSW_SPACE}
             )
 
             # Generate embeddings
@@ -710,18 +1126,13 @@ def process_audio():
             ids = [f"chunk_{i}" for i in range(len(chunks))]
 
             print(f"Generating embeddings for {len(texts)} audio chunks...")
-            embeddings = embedding_model.encode(texts, show_progress_bar=True).tolist()
+            embeddings = embed_texts(texts)
             print("Embeddings generated!")
 
-            collection.add(
-                embeddings=embeddings,
-                documents=texts,
-                metadatas=metadatas,
-                ids=ids
-            )
+            _bulk_add(collection, ids, embeddings, texts, metadatas)
 
             # Register the document
-            documents_registry[doc_id] = {
+            _registry_put({
                 'id': doc_id,
                 'type': 'audio',
                 'name': base_name,
@@ -731,8 +1142,7 @@ def process_audio():
                 'language': info.language,
                 'parent_workspace_id': workspace_id,
                 'created_at': datetime.now().isoformat()
-            }
-            save_registry()
+            })
 
             return jsonify({
                 'success': True,
@@ -754,6 +1164,19 @@ def process_audio():
         return jsonify({'error': str(e)}), 500
 
 
+def _stream_answer(first_chunk, stream, sources_used):
+    """Yield an NDJSON stream: the sources first, then answer text as Gemini produces it"""
+    yield app.json.dumps({'success': True, 'sources_used': sources_used}) + '\n'
+    try:
+        chunks = stream if first_chunk is None else itertools.chain([first_chunk], stream)
+        for chunk in chunks:
+            if chunk.text:
+                yield app.json.dumps({'delta': chunk.text}) + '\n'
+    except Exception as e:
+        print(f"Chat stream error: {str(e)}")
+        yield app.json.dumps({'error': str(e)}) + '\n'
+
+
 @app.route('/api/chat', methods=['POST'])
 def chat():
     """Handle chat queries about the video"""
@@ -765,30 +1188,20 @@ def chat():
         if not document_id or not question:
             return jsonify({'error': 'Missing document_id or question'}), 400
         
-        if document_id not in documents_registry:
-            return jsonify({'error': 'Document not processed yet'}), 400
-        
         # Get collection
-        doc_info = documents_registry[document_id]
-        collection_name = doc_info['collection_name']
-        collection = chroma_client.get_collection(collection_name)
-        
-        # Generate query embedding using local model (instant!)
-        query_embedding = embedding_model.encode([question])[0].tolist()
+        doc_info = _registry_get(document_id)
+        if not doc_info:
+            return jsonify({'error': 'Document not processed yet'}), 400
         
-        # Retrieve relevant chunks
-        results = collection.query(
-            query_embeddings=[query_embedding],
-            n_results=5
-        )
+        # Retrieve relevant chunks (query embedding + search are cached per question)
+        documents, metadatas = _retrieve(document_id, question.strip().lower())
         
-        if not results['documents'] or not results['documents'][0]:
+        if not documents:
             return jsonify({'success': True, 'answer': "No relevant content found in this document.", 'sources_used': []})
         
         # Build context from retrieved chunks
         context_parts = []
-        for i, doc in enumerate(results['documents'][0]):
-            metadata = results['metadatas'][0][i]
+        for doc, metadata in zip(documents, metadatas):
             # Handle both YouTube (start_time) and PDF (chunk_index) metadata
             if 'start_time' in metadata:
                 timestamp = int(metadata['start_time'])
@@ -801,7 +1214,6 @@ def chat():
         
         context = "\n\n".join(context_parts)
         
-        # Generate response using Gemini
         # Prepare dynamic prompt text based on document type
         doc_type = doc_info.get('type', 'document')
         
@@ -836,19 +1248,23 @@ RESPONSE GUIDELINES:
 
 Provide your response below:"""
         
-        response = client.models.generate_content(
-            model='gemini-2.5-flash-lite',
-            contents=prompt
-        )
-        
         # Build sources list (handle both YouTube and PDF metadata)
         sources_used = []
-        for meta in results['metadatas'][0]:
+        for meta in metadatas:
             if 'start_time' in meta:
                 sources_used.append({'timestamp': meta['start_time']})
             elif 'chunk_index' in meta:
                 sources_used.append({'chunk': meta['chunk_index']})
         
+        # Stream the answer as it is generated when the client asks for it
+        if data.get('stream'):
+            # Open the stream up front so retries apply and a failure still returns an error status
+            first_chunk, stream = open_answer_stream(prompt)
+            return Response(stream_with_context(_stream_answer(first_chunk, stream, sources_used)), mimetype='application/x-ndjson')
+        
+        # Generate response using Gemini
+        response = generate_answer(prompt)
+        
         return jsonify({
             'success': True,
             'answer': response.text,
@@ -882,58 +1298,54 @@ def create_workspace():
         except:
             pass
             
-        merged_collection = chroma_client.create_collection(merged_collection_name)
-        
-        sources = []
-        offset = 0
-        for doc_id in document_ids:
-            if doc_id not in documents_registry:
-                continue
-                
-            doc_info = documents_registry[doc_id]
+        merged_collection = chroma_client.create_collection(merged_collection_name, metadata=HNSW_SPACE)
+        
+        with _registry_write_lock:
+            sources = []
+            offset = 0
+            for doc_id in document_ids:
+                doc_info = _registry_get(doc_id)
+                if not doc_info:
+                    continue
             
-            # Store independent metadata copy for the workspace
-            sources.append({
-                'id': doc_info['id'],
-                'name': doc_info['name'],
-                'type': doc_info['type']
-            })
+                # Store independent metadata copy for the workspace
+                sources.append({
+                    'id': doc_info['id'],
+                    'name': doc_info['name'],
+                    'type': doc_info['type']
+                })
             
-            source_collection = chroma_client.get_collection(doc_info['collection_name'])
+                source_collection = chroma_client.get_collection(doc_info['collection_name'])
             
-            all_chunks = source_collection.get(include=['documents', 'metadatas', 'embeddings'])
+                all_chunks = source_collection.get(include=['documents', 'metadatas', 'embeddings'])
             
-            if not all_chunks['documents']:
-                continue
+                if not all_chunks['documents']:
+                    continue
                 
-            for i, (text, meta, embedding) in enumerate(zip(
-                all_chunks['documents'],
-                all_chunks['metadatas'],
-                all_chunks['embeddings']
-            )):
-                meta['source_doc_id'] = doc_id
-                meta['source_name'] = doc_info['name']
-                meta['source_type'] = doc_info['type']
-                
-                merged_collection.add(
-                    documents=[text],
-                    metadatas=[meta],
-                    embeddings=[embedding],
-                    ids=[f"merged_{doc_id}_{i}"]
+                for meta in all_chunks['metadatas']:
+                    meta['source_doc_id'] = doc_id
+                    meta['source_name'] = doc_info['name']
+                    meta['source_type'] = doc_info['type']
+            
+                _bulk_add(
+                    merged_collection,
+                    [f"merged_{doc_id}_{i}" for i in range(len(all_chunks['documents']))],
+                    all_chunks['embeddings'],
+                    all_chunks['documents'],
+                    all_chunks['metadatas']
                 )
             
-            offset += len(all_chunks['documents'])
+                offset += len(all_chunks['documents'])
             
-        workspaces[workspace_id] = {
-            'id': workspace_id,
-            'name': name,
-            'document_ids': document_ids,
-            'sources': sources,
-            'merged_collection': merged_collection_name,
-            'total_chunks': offset,
-            'created_at': datetime.now().isoformat()
-        }
-        save_registry()
+            _workspace_put({
+                'id': workspace_id,
+                'name': name,
+                'document_ids': document_ids,
+                'sources': sources,
+                'merged_collection': merged_collection_name,
+                'total_chunks': offset,
+                'created_at': datetime.now().isoformat()
+            })
         
         return jsonify({
             'success': True, 
@@ -956,15 +1368,14 @@ def workspace_chat():
         if not workspace_id or not question:
             return jsonify({'error': 'Missing workspace_id or question'}), 400
             
-        if workspace_id not in workspaces:
+        workspace = _workspace_get(workspace_id)
+        if not workspace:
             return jsonify({'error': 'Workspace not found'}), 404
             
-        workspace = workspaces[workspace_id]
-        merged_collection = chroma_client.get_collection(workspace['merged_collection'])
+        merged_collection = _get_collection(workspace['merged_collection'])
         
-        query_embedding = embedding_model.encode([question])[0].tolist()
         results = merged_collection.query(
-            query_embeddings=[query_embedding],
+            query_embeddings=_embed_query(question.strip().lower()),
             n_results=8
         )
         
@@ -1029,10 +1440,7 @@ RESPONSE GUIDELINES:
 
 Provide your response below:"""
 
-        response = client.models.generate_content(
-            model='gemini-2.5-flash-lite',
-            contents=prompt
-        )
+        response = generate_answer(prompt)
         
         return jsonify({
             'success': True,
@@ -1055,7 +1463,7 @@ Provide your response below:"""
 def list_workspaces():
     """List all created workspaces"""
     try:
-        ws_list = list(workspaces.values())
+        ws_list = _workspace_list()
         return jsonify({
             'success': True,
             'workspaces': ws_list,
@@ -1069,33 +1477,28 @@ def list_workspaces():
 def delete_workspace(workspace_id):
     """Delete a workspace"""
     try:
-        if workspace_id not in workspaces:
-            return jsonify({'error': 'Workspace not found'}), 404
-            
-        workspace = workspaces[workspace_id]
-        
-        try:
-            chroma_client.delete_collection(workspace['merged_collection'])
-        except Exception as e:
-            print(f"Warning: Could not delete merged collection {workspace['merged_collection']}: {str(e)}")
-            
-        del workspaces[workspace_id]
+        with _registry_write_lock:
+            workspace = _workspace_get(workspace_id)
+            if not workspace:
+                return jsonify({'error': 'Workspace not found'}), 404
         
-        # Completely destroy native documents uploaded into this workspace
-        docs_to_delete = []
-        for doc_id, doc in documents_registry.items():
-            if doc.get('parent_workspace_id') == workspace_id:
-                docs_to_delete.append(doc_id)
-                
-        for doc_id in docs_to_delete:
-            native_doc = documents_registry[doc_id]
             try:
-                chroma_client.delete_collection(native_doc['collection_name'])
-            except:
-                pass
-            del documents_registry[doc_id]
+                chroma_client.delete_collection(workspace['merged_collection'])
+            except Exception as e:
+                print(f"Warning: Could not delete merged collection {workspace['merged_collection']}: {str(e)}")
             
-        save_registry()
+            _workspace_del(workspace_id)
+        
+            # Completely destroy native documents uploaded into this workspace
+            for native_doc in _registry_list():
+                if native_doc.get('parent_workspace_id') != workspace_id:
+                    continue
+                try:
+                    chroma_client.delete_collection(native_doc['collection_name'])
+                except:
+                    pass
+                _registry_del(native_doc['id'])
+            _clear_collection_caches()
         
         return jsonify({
             'success': True,
@@ -1109,77 +1512,75 @@ def delete_workspace(workspace_id):
 def add_document_to_workspace(workspace_id):
     """Append a new document's chunks into an existing workspace's merged collection"""
     try:
-        if workspace_id not in workspaces:
-            return jsonify({'error': 'Workspace not found'}), 404
-
-        data = request.json
-        document_id = data.get('document_id')
+        # Held across the merge so concurrent adds can't reuse chunk ids or overwrite each other's workspace update
+        with _registry_write_lock:
+            workspace = _workspace_get(workspace_id)
+            if not workspace:
+                return jsonify({'error': 'Workspace not found'}), 404
 
-        if not document_id:
-            return jsonify({'error': 'document_id is required'}), 400
+            data = request.json
+            document_id = data.get('document_id')
 
-        if document_id not in documents_registry:
-            return jsonify({'error': 'Document not found'}), 404
+            if not document_id:
+                return jsonify({'error': 'document_id is required'}), 400
 
-        # Automatically tag notes with the workspace ID for isolation
-        doc = documents_registry[document_id]
-        if doc.get('type') == 'note' and not doc.get('parent_workspace_id'):
-            doc['parent_workspace_id'] = workspace_id
-            print(f"📌 Auto-tagging note {document_id} with workspace {workspace_id}")
+            doc_info = _registry_get(document_id)
+            if not doc_info:
+                return jsonify({'error': 'Document not found'}), 404
 
-        workspace = workspaces[workspace_id]
+            # Automatically tag notes with the workspace ID for isolation
+            if doc_info.get('type') == 'note' and not doc_info.get('parent_workspace_id'):
+                doc_info['parent_workspace_id'] = workspace_id
+                _registry_put(doc_info)
+                print(f"📌 Auto-tagging note {document_id} with workspace {workspace_id}")
 
-        # Prevent adding a document that's already in the workspace
-        if document_id in workspace.get('document_ids', []):
-            return jsonify({'error': 'Document already exists in this workspace'}), 409
+            # Prevent adding a document that's already in the workspace
+            if document_id in workspace.get('document_ids', []):
+                return jsonify({'error': 'Document already exists in this workspace'}), 409
 
-        doc_info = documents_registry[document_id]
-        source_collection = chroma_client.get_collection(doc_info['collection_name'])
-        merged_collection = chroma_client.get_collection(workspace['merged_collection'])
+            source_collection = chroma_client.get_collection(doc_info['collection_name'])
+            merged_collection = chroma_client.get_collection(workspace['merged_collection'])
 
-        # Pull all chunks from the source document
-        all_chunks = source_collection.get(include=['documents', 'metadatas', 'embeddings'])
+            # Pull all chunks from the source document
+            all_chunks = source_collection.get(include=['documents', 'metadatas', 'embeddings'])
 
-        if not all_chunks['documents']:
-            return jsonify({'error': 'Document has no chunks to merge'}), 400
+            if not all_chunks['documents']:
+                return jsonify({'error': 'Document has no chunks to merge'}), 400
 
-        # Use a unique prefix based on current merged count to avoid ID collisions
-        existing_count = merged_collection.count()
+            # Use a unique prefix based on current merged count to avoid ID collisions
+            existing_count = merged_collection.count()
 
-        for i, (text, meta, embedding) in enumerate(zip(
-            all_chunks['documents'],
-            all_chunks['metadatas'],
-            all_chunks['embeddings']
-        )):
-            meta['source_doc_id'] = document_id
-            meta['source_name'] = doc_info['name']
-            meta['source_type'] = doc_info['type']
+            for meta in all_chunks['metadatas']:
+                meta['source_doc_id'] = document_id
+                meta['source_name'] = doc_info['name']
+                meta['source_type'] = doc_info['type']
 
-            merged_collection.add(
-                documents=[text],
-                metadatas=[meta],
-                embeddings=[embedding],
-                ids=[f"merged_{document_id}_{existing_count + i}"]
+            _bulk_add(
+                merged_collection,
+                [f"merged_{document_id}_{existing_count + i}" for i in range(len(all_chunks['documents']))],
+                all_chunks['embeddings'],
+                all_chunks['documents'],
+                all_chunks['metadatas']
             )
 
-        # Ensure workspace has a sources array
-        if 'sources' not in workspace:
-            workspace['sources'] = []
+            # Ensure workspace has a sources array
+            if 'sources' not in workspace:
+                workspace['sources'] = []
 
-        # Update workspace metadata
-        if document_id not in workspace.get('document_ids', []):
-            workspace.setdefault('document_ids', []).append(document_id)
+            # Update workspace metadata
+            if document_id not in workspace.get('document_ids', []):
+                workspace.setdefault('document_ids', []).append(document_id)
             
-        # Avoid duplicate source entries when appending multiple times
-        if not any(s['id'] == document_id for s in workspace['sources']):
-            workspace['sources'].append({
-                'id': doc_info['id'], 
-                'name': doc_info['name'], 
-                'type': doc_info['type']
-            })
+            # Avoid duplicate source entries when appending multiple times
+            if not any(s['id'] == document_id for s in workspace['sources']):
+                workspace['sources'].append({
+                    'id': doc_info['id'], 
+                    'name': doc_info['name'], 
+                    'type': doc_info['type']
+                })
 
-        workspace['total_chunks'] = workspace.get('total_chunks', 0) + len(all_chunks['documents'])
-        save_registry()
+            workspace['total_chunks'] = workspace.get('total_chunks', 0) + len(all_chunks['documents'])
+            _workspace_put(workspace)
 
         return jsonify({
             'success': True,
@@ -1201,7 +1602,7 @@ def add_document_to_workspace(workspace_id):
 def list_documents():
     """List all processed documents"""
     try:
-        documents = list(documents_registry.values())
+        documents = _registry_list()
         return jsonify({
             'success': True,
             'documents': documents,
@@ -1215,33 +1616,33 @@ def list_documents():
 def delete_document(document_id):
     """Delete a processed document"""
     try:
-        if document_id not in documents_registry:
-            return jsonify({'error': 'Document not found'}), 404
-        
         # Get document info
-        doc_info = documents_registry[document_id]
-        collection_name = doc_info['collection_name']
+        with _registry_write_lock:
+            doc_info = _registry_get(document_id)
+            if not doc_info:
+                return jsonify({'error': 'Document not found'}), 404
         
-        # Delete ChromaDB collection
-        try:
-            chroma_client.delete_collection(collection_name)
-        except Exception as e:
-            print(f"Warning: Could not delete collection {collection_name}: {str(e)}")
+            collection_name = doc_info['collection_name']
         
-        # Remove from registry
-        del documents_registry[document_id]
+            # Delete ChromaDB collection
+            try:
+                chroma_client.delete_collection(collection_name)
+            except Exception as e:
+                print(f"Warning: Could not delete collection {collection_name}: {str(e)}")
+            _clear_collection_caches()
         
-        # Clean up stale workspace references
-        for ws_id, ws in workspaces.items():
-            if document_id in ws.get('document_ids', []):
-                try:
+            # Remove from registry
+            _registry_del(document_id)
+        
+            # Clean up stale workspace references
+            for ws in _workspace_list():
+                if document_id in ws.get('document_ids', []):
                     ws['document_ids'].remove(document_id)
-                except ValueError:
-                    pass  # Already not in list
-            if 'sources' in ws:
-                ws['sources'] = [src for src in ws['sources'] if src['id'] != document_id]
-                
-        save_registry()
+                elif not any(src['id'] == document_id for src in ws.get('sources', [])):
+                    continue
+                if 'sources' in ws:
+                    ws['sources'] = [src for src in ws['sources'] if src['id'] != document_id]
+                _workspace_put(ws)
         
         return jsonify({
             'success': True,
@@ -1263,27 +1664,33 @@ def rename_item():
         if not item_type or not item_id or not new_name:
             return jsonify({'error': 'Missing type, id, or name'}), 400
             
-        if item_type == 'document':
-            if item_id in documents_registry:
-                documents_registry[item_id]['name'] = new_name
+        with _registry_write_lock:
+            if item_type == 'document':
+                doc = _registry_get(item_id)
+                if doc:
+                    doc['name'] = new_name
+                    _registry_put(doc)
                 
-                # Propagate rename to all internal workspace copies
-                for ws in workspaces.values():
-                    if 'sources' in ws:
-                        for src in ws['sources']:
+                    # Propagate rename to all internal workspace copies
+                    for ws in _workspace_list():
+                        renamed = False
+                        for src in ws.get('sources', []):
                             if src['id'] == item_id:
                                 src['name'] = new_name
+                                renamed = True
+                        if renamed:
+                            _workspace_put(ws)
                                 
-                save_registry()
-                return jsonify({'success': True})
-            return jsonify({'error': 'Document not found'}), 404
+                    return jsonify({'success': True})
+                return jsonify({'error': 'Document not found'}), 404
             
-        elif item_type == 'workspace':
-            if item_id in workspaces:
-                workspaces[item_id]['name'] = new_name
-                save_registry()
-                return jsonify({'success': True})
-            return jsonify({'error': 'Workspace not found'}), 404
+            elif item_type == 'workspace':
+                workspace = _workspace_get(item_id)
+                if workspace:
+                    workspace['name'] = new_name
+                    _workspace_put(workspace)
+                    return jsonify({'success': True})
+                return jsonify({'error': 'Workspace not found'}), 404
             
         return jsonify({'error': 'Invalid type'}), 400
     except Exception as e:
@@ -0,0 +1,22 @@
+"""PDF text extraction that runs inside the PDF process pool.
+
+This module deliberately imports nothing but pypdfium2. Workers still
+re-import the __main__ script, which is why app.py only uses the pool when it
+is not itself __main__ (e.g. under gunicorn) and extracts serially otherwise.
+"""
+import pypdfium2 as pdfium
+
+
+def extract_page_range(pdf_data, start, stop):
+    """Extract pages [start, stop) from PDF bytes as (page_index, text, error) tuples"""
+    pdf = pdfium.PdfDocument(pdf_data)
+    try:
+        results = []
+        for page_index in range(start, stop):
+            try:
+                results.append((page_index, pdf[page_index].get_textpage().get_text_range(), None))
+            except Exception as e:
+                results.append((page_index, None, str(e)))
+        return results
+    finally:
+        pdf.close()
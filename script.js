@@ -795,6 +795,50 @@ function renderMessage(text, sender, sources = null) {
     }
     chatMessages.appendChild(el);
     chatMessages.scrollTop = chatMessages.scrollHeight;
+    return el;
+}
+
+// Read an NDJSON chat stream, rendering the answer as it arrives
+async function readChatStream(response) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let answer = '';
+    let sources = [];
+    let el = null;
+
+    const handleLine = (line) => {
+        if (!line.trim()) return;
+        const msg = JSON.parse(line);
+        if (msg.error) throw new Error(msg.error);
+        if (msg.sources_used) sources = msg.sources_used;
+        if (msg.delta) {
+            answer += msg.delta;
+            if (!el) {
+                typingIndicator.classList.add('hidden');
+                el = renderMessage(answer, 'ai');
+            } else {
+                el.querySelector('.markdown-body').innerHTML = parseMarkdown(answer);
+                chatMessages.scrollTop = chatMessages.scrollHeight;
+            }
+        }
+    };
+
+    try {
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            const lines = buffer.split('\n');
+            buffer = lines.pop();
+            lines.forEach(handleLine);
+        }
+        handleLine(buffer);
+    } finally {
+        // Swap the live message for the final render with its sources
+        if (el) el.remove();
+    }
+    return { answer, sources };
 }
 
 sendBtn.addEventListener('click', sendChat);
@@ -818,6 +862,7 @@ async function sendChat() {
             payload.workspace_id = currentWorkspaceId;
         } else {
             payload.document_id = currentDocumentId;
+            payload.stream = true;
         }
 
         const response = await fetch(endpoint, {
@@ -826,6 +871,14 @@ async function sendChat() {
             body: JSON.stringify(payload)
         });
 
+        if (response.ok && (response.headers.get('Content-Type') || '').includes('application/x-ndjson')) {
+            const { answer, sources } = await readChatStream(response);
+            typingIndicator.classList.add('hidden');
+            renderMessage(answer, 'ai', sources);
+            saveHistory(answer, 'ai', sources);
+            return;
+        }
+
         const data = await response.json();
         typingIndicator.classList.add('hidden');
         if (!response.ok) throw new Error(data.error);